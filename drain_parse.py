@@ -1,171 +1,576 @@
-import json
+import argparse
+import asyncio
+import functools
+import hashlib
+import io
+import itertools
 import logging
+import multiprocessing
 import os
-import subprocess
+import pathlib
 import sys
-import time
-from os.path import dirname
-from typing import List, Dict, Any, Tuple
-from drain3 import TemplateMiner
-from drain3.template_miner_config import TemplateMinerConfig
-from masker import LogMasker
-from collections import defaultdict
-import re
-import argparse
-import wget
-import hashlib
+import uuid
+from collections import Counter, defaultdict, deque
+from operator import attrgetter
+from typing import List, Dict, Any, Iterable, Tuple, Union
 from urllib.parse import urlparse
-import pathlib
+
+import aiofiles
+import aiohttp
 import gptscript
-import asyncio
+import orjson
+import zstandard
 
-ini_content = """[SNAPSHOT]
-snapshot_interval_minutes = 10
-compress_state = True
-
-[DRAIN]
-# engine is Optional parameter. Engine will be "Drain" if the engine argument is not specified.
-# engine has two options: 'Drain' and 'JaccardDrain'.
-# engine = Drain
-sim_th = 0.7
-depth = 6
-max_children = 512
-max_clusters = 1024
-
-[PROFILING]
-enabled = True
-report_sec = 30
-"""
-
-# File path for the INI file
-drain_config_file = "drain3.ini"
-
-# Check if the file exists
-if not os.path.exists(drain_config_file):
-    # If the file does not exist, create it
-    with open(drain_config_file, "w") as fout:
-        fout.write(ini_content)
+from drain3 import TemplateMiner
+from drain3.drain import LogCluster, Node
+from drain3.template_miner_config import TemplateMinerConfig
+from masker import LogMasker
 
+# Drain settings, set directly rather than written to and re-read from a drain3.ini file
+# on every start. engine is left at its default, "Drain" ("JaccardDrain" is the other option).
 config = TemplateMinerConfig()
-config.load(drain_config_file)
+config.snapshot_interval_minutes = 10
+config.snapshot_compress_state = True
+config.drain_sim_th = 0.7
+config.drain_depth = 6
+config.drain_max_children = 512
+config.drain_max_clusters = 1024
 config.profiling_enabled = True
+config.profiling_report_sec = 30
+
+# Default masker of every parsing pass, so its regexes are compiled once per process.
+# Its memoized results are per process too: separate `analyze` / `extract` runs each
+# start with an empty cache, and so does each pool worker's (unpickled) copy.
+log_masker = LogMasker()
+
+# 1 MiB read buffer: far fewer read() syscalls than the 8 KiB default on large logs
+LOG_READ_BUFFER_SIZE = 1 << 20
+
+# downloads are streamed to disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# large logs can take far longer than aiohttp's default 5 minute total timeout to
+# download, so only a stalled read (no data for this many seconds) aborts a download;
+# connecting keeps aiohttp's default limit
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
+
+# at most this many masked line -> cluster id entries are saved in the snapshot
+SNAPSHOT_MASKED_LINE_CACHE_SIZE = config.drain_max_clusters * 4
+
+# lines per unit of work for the per-line passes (masking, parameter extraction); inputs
+# no larger than one batch are processed in-process since starting a worker pool would
+# cost more than it saves
+PARALLEL_BATCH_SIZE = 20_000
+
+# upper bound on the default number of worker processes: the per-batch results all come
+# back through the parent, so more workers than this mostly add memory, not speed
+MAX_WORKER_PROCESSES = 8
+
+# batches queued or being worked on at a time, per worker process
+BATCHES_IN_FLIGHT_PER_PROCESS = 2
+
+
+# start method of the worker pools, see `_map_batches`
+_POOL_START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def _default_processes():
+    """The CPUs this process may run on (not the host's count, where the platform tells
+    them apart), capped at MAX_WORKER_PROCESSES."""
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS or Windows
+        available = os.cpu_count() or 1
+    return min(available, MAX_WORKER_PROCESSES)
+
+
+def _map_batches(log_lines, func, worker_func, processes=None, initializer=None, initargs=()):
+    """Yield the result of each consecutive batch of `log_lines`, in input order.
+
+    Inputs spanning more than one batch are spread over a pool of `processes` workers
+    (default: `_default_processes()`) running `worker_func`, set up by
+    `initializer(*initargs)`; smaller inputs are handled in-process by `func`.
+
+    The workers are not forked: by the time this runs inside the asyncio loop, gptscript
+    and aiohttp may have started threads, and forking a threaded process can deadlock on a
+    lock held at fork time. They are started by a fork server where the platform has one
+    (spawned otherwise) and receive a pickled copy of `initargs` (the trained miner, the
+    masker) once each, when they start.
+    """
+    if processes is None:
+        processes = _default_processes()
+
+    # the first two batches are read ahead: a pool is only worth starting for a second one
+    batches = _batched(log_lines, PARALLEL_BATCH_SIZE)
+    first_batches = list(itertools.islice(batches, 2))
+    batches = itertools.chain(first_batches, batches)
+
+    if processes > 1 and len(first_batches) == 2:
+        with multiprocessing.get_context(_POOL_START_METHOD).Pool(
+            processes, initializer=initializer, initargs=initargs
+        ) as pool:
+            # only a bounded number of batches is submitted ahead of the results being
+            # consumed, so `log_lines` is read as fast as the workers go rather than all
+            # at once (Pool.imap's feeder thread would queue the whole input up front)
+            pending = deque()
+            max_pending = processes * BATCHES_IN_FLIGHT_PER_PROCESS
+            for batch in batches:
+                if len(pending) >= max_pending:
+                    yield pending.popleft().get()
+                pending.append(pool.apply_async(worker_func, (batch,)))
+            while pending:
+                yield pending.popleft().get()
+    else:
+        for batch in batches:
+            yield func(batch)
 
 
 def get_log_lines(log_file_path):
+    """Lazily yield stripped lines from a log file, one at a time."""
     if not os.path.exists(log_file_path):
         raise FileNotFoundError(f"Log file not found: {log_file_path}")
 
+    return _iter_log_lines(log_file_path)
+
+
+def _iter_log_lines(log_file_path):
     try:
-        with open(log_file_path, "r", encoding="utf-8") as file:
-            return [line.strip() for line in file]
+        with open(
+            log_file_path, "r", encoding="utf-8", buffering=LOG_READ_BUFFER_SIZE
+        ) as file:
+            for line in file:
+                yield line.strip()
     except Exception as e:
         logging.error(f"Error reading log file: {e}")
         raise
 
 
-def parse_log_file(log_lines):
-    if not log_lines:
+def _count_masked_batch(masker, log_lines):
+    # Counter's constructor counts in C; only the masking itself runs in Python
+    mask = masker.mask
+    return Counter(mask(line)[0] for line in log_lines)
+
+
+# masker of a masking worker process, set once by _init_masking_worker
+_worker_masker = None
+
+
+def _init_masking_worker(masker):
+    global _worker_masker
+    _worker_masker = masker
+
+
+def _count_masked_batch_in_worker(log_lines):
+    return _count_masked_batch(_worker_masker, log_lines)
+
+
+def count_masked_lines(log_lines, processes=None, masker=None):
+    """Mask the given (already stripped) lines and count each distinct masked line.
+
+    Real logs repeat the same masked line many times; the counts (in order of first
+    appearance) are all Drain needs to be trained, see `train_template_miner`.
+    Masking is the costly, per-line part, so it is spread over `processes` workers
+    (see `_map_batches`); merging the per-batch counts in order keeps first-seen order.
+    `masker` defaults to the shared module-level `log_masker`.
+    """
+    if masker is None:
+        masker = log_masker
+
+    masked_line_counts = Counter()
+    for batch_counts in _map_batches(
+        log_lines,
+        functools.partial(_count_masked_batch, masker),
+        _count_masked_batch_in_worker,
+        processes,
+        initializer=_init_masking_worker,
+        initargs=(masker,),
+    ):
+        masked_line_counts.update(batch_counts)
+
+    if not masked_line_counts:
         raise ValueError("Empty log lines provided")
 
+    return masked_line_counts
+
+
+def train_template_miner(masked_line_counts, masked_line_clusters=None):
+    """Train a TemplateMiner once per distinct masked line, then bump each cluster's
+    size by the remaining occurrences.
+
+    If `masked_line_clusters` is a dict, it is filled with the cluster id assigned to
+    each distinct masked line, so the parameter pass can skip matching them again.
+    """
     template_miner = TemplateMiner(config=config)
-    masker = LogMasker()
-    for line in log_lines:
-        line = line.rstrip()
-        masked_line, _ = masker.mask(line)
+    for masked_line, count in masked_line_counts.items():
         result = template_miner.add_log_message(masked_line)
+        if masked_line_clusters is not None:
+            masked_line_clusters[masked_line] = result["cluster_id"]
+        if count > 1:
+            template_miner.drain.id_to_cluster[result["cluster_id"]].size += count - 1
 
     return template_miner
 
 
+def snapshot_masked_line_clusters(masked_line_counts, masked_line_clusters, size=SNAPSHOT_MASKED_LINE_CACHE_SIZE):
+    """The masked line -> cluster id entries of the `size` most frequent masked lines.
+
+    Only these are worth a snapshot entry; extract matches the rest against the
+    restored tree.
+    """
+    return {
+        masked_line: masked_line_clusters[masked_line]
+        for masked_line, _ in masked_line_counts.most_common(size)
+    }
+
+
+def parse_log_file(log_lines, masked_line_clusters=None, masker=None):
+    """Train a TemplateMiner on the given (already stripped) lines."""
+    return train_template_miner(
+        count_masked_lines(log_lines, masker=masker), masked_line_clusters
+    )
+
+
+# the token Drain puts in place of a variable part of a template
+DRAIN_WILDCARD = "<*>"
+
+
 def get_tokens(s):
-    parts = re.split(r"(<[^>]*>)", s)
-    # Remove any empty strings from the result
-    return [part for part in parts if part]
+    """Split `s` into literal parts and `<...>` mask tokens, e.g. `a<PATH><NUM>` ->
+    [`a`, `<PATH>`, `<NUM>`]."""
+    if "<" not in s:  # plain token, the common case
+        return [s]
+
+    # one pass with str.find: each `<` up to the next `>` is a mask token
+    tokens = []
+    start = 0
+    while (open_at := s.find("<", start)) != -1:
+        close_at = s.find(">", open_at + 1)
+        if close_at == -1:
+            break
+        if open_at > start:
+            tokens.append(s[start:open_at])
+        tokens.append(s[open_at : close_at + 1])
+        start = close_at + 1
+    if start < len(s):
+        tokens.append(s[start:])
+    return tokens
+
+
+@functools.lru_cache(maxsize=4096)
+def _template_plan(template):
+    """Split a template once and locate the positions that can hold parameters.
+
+    Literal template tokens carry no parameters, so extract_parameters only visits
+    the positions holding `<*>` or a mask token (in order, as each mask token takes the
+    next of its values).
+    There are few distinct templates, so this is computed once per template, not per line.
+    """
+    template_tokens = tuple(template.split())
+    param_positions = tuple(i for i, token in enumerate(template_tokens) if "<" in token)
+    return template_tokens, param_positions
 
 
 def extract_parameters(template, masked_line, parameters):
-    template_tokens = template.split()
+    """Return the (token, value) pairs of a masked line's parameters, in order.
+
+    `parameters` is the masker's dict of mask token -> values; each mask token found in
+    the line takes the next value of its list. The dict is left untouched.
+    A line whose mask tokens and values do not line up is dropped (an empty list).
+
+    The pairs are recovered by walking the template rather than taken straight from the
+    masker: a `<*>` position is rebuilt from its masked log token (e.g. `ip-<IP>` ->
+    `ip-10.0.0.1`), which only the template walk sees.
+    """
+    if "<" not in template:
+        return []  # neither `<*>` nor mask tokens: no parameters
+
+    template_tokens, param_positions = _template_plan(template)
     log_tokens = masked_line.split()
 
     if len(template_tokens) != len(log_tokens):
         return []  # Return empty list if tokens don't match
 
-    # Extract parameters
+    # Extract parameters, reading each token's values through its own cursor
+    cursors = {}
+
+    def next_value(token):
+        values = parameters.get(token)
+        index = cursors.get(token, 0)
+        if values is None or index >= len(values):
+            return None
+        cursors[token] = index + 1
+        return values[index]
+
     new_parameters = []
-    for template_token, log_token in zip(template_tokens, log_tokens):        
+    for i in param_positions:
+        template_token = template_tokens[i]
         if (
-            template_token == "<*>"
+            template_token == DRAIN_WILDCARD
         ):  # template token is <*>, but the log token can be `fleet.cattle.io<PATH>` or `<PATH><DIGITS>` which requires more processing
-            param_name = template_token
-            split_log_tokens = get_tokens(log_token)
+            split_log_tokens = get_tokens(log_tokens[i])
             res_full_string = ""
             for each_token in split_log_tokens:
-                if each_token in parameters:
-                    actual_log_token = parameters[each_token].pop(0)
-                    res_full_string += actual_log_token
-                else:
+                if each_token not in parameters:
                     res_full_string += each_token
-            new_parameters.append({"token": param_name, "value": res_full_string})
+                    continue
+                value = next_value(each_token)
+                if value is None:
+                    return []  # the token's values are used up
+                if isinstance(value, tuple):
+                    # the value of a pattern with several groups (IP, NUM, DURATION, ...)
+                    # holds the groups, not the matched text, so it cannot be spliced back
+                    # into the text of a `<*>` position: the line is skipped, as it
+                    # always has been
+                    return []
+                else:
+                    res_full_string += value
+            new_parameters.append((DRAIN_WILDCARD, res_full_string))
 
         else:
             tokens = get_tokens(
                 template_token
             )  # template token can be something like `fleet.cattle.io<PATH>` or `<PATH><DIGITS>`, so we split them and examine each part
             for token in tokens:
-                if token.startswith("<") and token.endswith(">"):
-                    actual_log_token = parameters[token].pop(0)
-                    new_parameters.append({"token": token, "value": actual_log_token})
+                if token[0] == "<" and token[-1] == ">":
+                    value = next_value(token)
+                    if value is None:
+                        return []  # no (more) values for this mask token
+                    new_parameters.append((token, value))
         # TODO: can template_token be a string like `fleet.cattle.io<*>`? hopefully not.
     return new_parameters
 
 
 def display_clusters(template_miner):
     sorted_clusters = sorted(
-        template_miner.drain.clusters, key=lambda it: it.size, reverse=True
+        template_miner.drain.clusters, key=attrgetter("size"), reverse=True
     )
-    print(f"----------clusters:--------------------")
+    # collect the report and write it in one call rather than one print per cluster
+    lines = [f"----------clusters:--------------------"]
     res = []
     for cluster in sorted_clusters:
-        print(cluster)
+        lines.append(str(cluster))
         res.append(cluster.get_template())
+    sys.stdout.write("\n".join(lines) + "\n")
     return res
 
 
-def get_parameters_by_cluster(template_miner, log_lines):
-    masker = LogMasker()
-    parameters_by_cluster = defaultdict(list)
+def _parameters_for_lines(template_miner, masker, masked_line_clusters, log_lines, target_cluster_id=None):
+    """Match each (already stripped) line against the trained miner; returns (cluster_id, entry) pairs in input order.
+
+    With a `target_cluster_id`, lines of every other cluster are dropped before their
+    parameters are extracted.
+
+    Errors are caught per batch rather than per line: if a line of the batch fails, the
+    batch is processed again one line at a time, and only the failing lines are dropped.
+    """
+    try:
+        return _match_lines(
+            template_miner, masker, masked_line_clusters, log_lines, target_cluster_id
+        )
+    except Exception:
+        pass
 
+    results = []
     for line in log_lines:
         try:
-            line = line.rstrip()
-            masked_line, parameters = masker.mask(line)
+            results.extend(
+                _match_lines(
+                    template_miner, masker, masked_line_clusters, (line,), target_cluster_id
+                )
+            )
+        except Exception as e:
+            logging.warning(f"Error processing line: {line}. Error: {str(e)}")
+    return results
+
+
+def _match_lines(template_miner, masker, masked_line_clusters, log_lines, target_cluster_id):
+    results = []
+    # this loop runs once per log line: bind the bound methods it calls to locals
+    mask = masker.mask
+    get_known_cluster_id = masked_line_clusters.get
+    get_cluster = template_miner.drain.id_to_cluster.get
+    append_result = results.append
+    # the trained miner no longer changes, so each cluster's template is joined only once
+    # (and extract_parameters then finds its split form in the _template_plan cache),
+    # along with whether it has any parameter position at all
+    templates = {}
+    for line in log_lines:
+        masked_line, parameters = mask(line)
+        # reuse the cluster assigned during training or by an earlier match;
+        # only masked lines seen for the first time walk the Drain tree
+        matched_cluster = None
+        known_cluster_id = get_known_cluster_id(masked_line)
+        if known_cluster_id is not None:
+            matched_cluster = get_cluster(known_cluster_id)
+        if matched_cluster is None:
             matched_cluster = template_miner.match(masked_line)
-
             if matched_cluster:
+                masked_line_clusters[masked_line] = matched_cluster.cluster_id
+
+        if matched_cluster:
+            cluster_id = matched_cluster.cluster_id
+            if target_cluster_id is not None and cluster_id != target_cluster_id:
+                continue
+            template_info = templates.get(cluster_id)
+            if template_info is None:
                 template = matched_cluster.get_template()
-                cluster_id = matched_cluster.cluster_id
+                template_info = templates[cluster_id] = (template, "<" in template)
+            template, has_params = template_info
+            if not has_params:  # a purely literal template has nothing to extract
+                continue
+
+            params = extract_parameters(template, masked_line, parameters)
+            if params:  # Only add if we got parameters
+                append_result((cluster_id, {"line": line, "parameters": params}))
+
+    return results
+
+
+# state of a parameter-extraction worker process, set once by _init_parameters_worker
+_worker_template_miner = None
+_worker_masked_line_clusters = None
+_worker_target_cluster_id = None
+
+
+def _init_parameters_worker(template_miner, masker, masked_line_clusters, target_cluster_id):
+    global _worker_template_miner, _worker_masked_line_clusters, _worker_target_cluster_id
+    _init_masking_worker(masker)
+    _worker_template_miner = template_miner
+    _worker_masked_line_clusters = masked_line_clusters
+    _worker_target_cluster_id = target_cluster_id
+
+
+def _parameters_for_lines_in_worker(log_lines):
+    return _parameters_for_lines(
+        _worker_template_miner,
+        _worker_masker,
+        _worker_masked_line_clusters,
+        log_lines,
+        _worker_target_cluster_id,
+    )
 
-                params = extract_parameters(template, masked_line, parameters)
-                if params:  # Only add if we got parameters
-                    parameters_by_cluster[cluster_id].append(
-                        {"line": line, "parameters": params}
-                    )
-        except Exception as e:
-            logging.warning(f"Error processing line: {line}. Error: {str(e)}")
-            continue
+
+def iter_parameters(template_miner, log_lines, masked_line_clusters=None, processes=None, masker=None, target_cluster_id=None):
+    """Lazily yield (cluster_id, entry) for every line with parameters, in input order.
+
+    `masked_line_clusters` is the mapping filled in by `parse_log_file`; lines found in
+    it reuse their training-time cluster instead of being matched again, and new
+    matches are added to it.
+
+    Training is inherently sequential, but matching against the trained miner is
+    read-only, so the lines are spread over `processes` workers (see `_map_batches`).
+
+    `masker` must be the one the miner was trained with; it defaults to the shared
+    module-level `log_masker`. With a `target_cluster_id`, only that cluster's lines
+    are extracted (and sent back from the workers).
+    """
+    if masked_line_clusters is None:
+        masked_line_clusters = {}
+    if masker is None:
+        masker = log_masker
+
+    for results in _map_batches(
+        log_lines,
+        functools.partial(
+            _parameters_for_lines,
+            template_miner,
+            masker,
+            masked_line_clusters,
+            target_cluster_id=target_cluster_id,
+        ),
+        _parameters_for_lines_in_worker,
+        processes,
+        initializer=_init_parameters_worker,
+        initargs=(template_miner, masker, masked_line_clusters, target_cluster_id),
+    ):
+        yield from results
+
+
+def get_parameters_by_cluster(template_miner, log_lines, masked_line_clusters=None, processes=None, masker=None):
+    """Extract parameters of every line, grouped by the id of the cluster it matches.
+
+    See `iter_parameters` for the arguments.
+    """
+    parameters_by_cluster = defaultdict(list)
+    for cluster_id, entry in iter_parameters(
+        template_miner, log_lines, masked_line_clusters, processes, masker
+    ):
+        parameters_by_cluster[cluster_id].append(entry)
 
     return dict(parameters_by_cluster)  # Convert defaultdict to regular dict
 
 
-def get_log_templates(log_lines: List[str]) -> Tuple[List[str], TemplateMiner, List[str]]:
-    """Process a log file and extract templates."""
-    # log_lines = get_log_lines(log_file_path)
-    
+def get_parameters_for_cluster(template_miner, log_lines, target_cluster_id, masked_line_clusters=None, processes=None, masker=None):
+    """Lazily yield the entries of a single cluster; the other clusters' lines are
+    skipped during the scan, before any parameter extraction."""
+    for _, entry in iter_parameters(
+        template_miner,
+        log_lines,
+        masked_line_clusters,
+        processes,
+        masker,
+        target_cluster_id=target_cluster_id,
+    ):
+        yield entry
+
+
+def print_json(obj, indent=False):
+    """Write `obj` to stdout as JSON, serialized by orjson straight to bytes."""
+    sys.stdout.flush()  # keep ordering with text already printed
+    option = orjson.OPT_INDENT_2 if indent else 0
+    sys.stdout.buffer.write(orjson.dumps(obj, option=option) + b"\n")
+
+
+def parameter_entry_as_json(entry):
+    """Expand the compact (token, value) pairs of an entry into JSON objects."""
+    return {
+        "line": entry["line"],
+        "parameters": [
+            {"token": token, "value": value} for token, value in entry["parameters"]
+        ],
+    }
+
+
+def print_cluster_parameters(cluster_id, template, entries):
+    """Stream a cluster's entries to stdout as a single JSON object, one entry at a time.
+
+    Nothing is written if there are no entries; returns whether anything was written.
+    """
+    entries = iter(entries)
+    first_entry = next(entries, None)
+    if first_entry is None:
+        return False
+
+    sys.stdout.flush()  # keep ordering with text already printed
+    out = sys.stdout.buffer
+    header = orjson.dumps({"cluster_id": cluster_id, "template": template})
+    out.write(header[:-1] + b',"parameters":[')
+    out.write(orjson.dumps(parameter_entry_as_json(first_entry)))
+    for entry in entries:
+        out.write(b"," + orjson.dumps(parameter_entry_as_json(entry)))
+    out.write(b"]}\n")
+    return True
+
+
+def get_log_templates(log_lines: Iterable[str]) -> Tuple[List[str], TemplateMiner]:
+    """Process log lines and extract templates.
+
+    `log_lines` may be a one-shot iterator such as `get_log_lines(path)`, so it is not
+    handed back: for a second pass over the lines, call `get_log_lines` again.
+    """
     template_miner = parse_log_file(log_lines)
 
     clusters = [cluster.get_template() for cluster in template_miner.drain.clusters]
 
-    return clusters, template_miner, log_lines
+    return clusters, template_miner
 
 
 def get_cache_filename(url: str) -> str:
@@ -232,67 +637,218 @@ def prepend_base_path(base_path: str, file_path: str):
     return os.path.join(base_path, file_path)
 
 
+def _dump_node(node: Node) -> Dict[str, Any]:
+    return {
+        "cluster_ids": list(node.cluster_ids),
+        "children": {key: _dump_node(child) for key, child in node.key_to_child_node.items()},
+    }
+
+
+def _load_node(state: Dict[str, Any]) -> Node:
+    node = Node()
+    node.cluster_ids = [int(cluster_id) for cluster_id in state["cluster_ids"]]
+    node.key_to_child_node = {
+        str(key): _load_node(child) for key, child in state["children"].items()
+    }
+    return node
+
+
+def dump_template_miner_state(template_miner) -> Dict[str, Any]:
+    """Describe a trained miner's Drain state (clusters and prefix tree) as plain JSON data.
+
+    drain3's own `save_state` is not used: its jsonpickle encoding names the classes to
+    build on load, so a tampered snapshot could run arbitrary code.
+    """
+    drain = template_miner.drain
+    clusters = list(drain.clusters)
+    return {
+        "clusters_counter": drain.clusters_counter,
+        "cluster_ids": [cluster.cluster_id for cluster in clusters],
+        "cluster_sizes": [cluster.size for cluster in clusters],
+        "cluster_tokens": [list(cluster.log_template_tokens) for cluster in clusters],
+        "root": _dump_node(drain.root_node),
+    }
+
+
+def load_template_miner_state(state: Dict[str, Any]) -> TemplateMiner:
+    """Rebuild a TemplateMiner from the output of `dump_template_miner_state`; only
+    clusters, tree nodes, strings and numbers are created."""
+    template_miner = TemplateMiner(config=config)
+    drain = template_miner.drain
+    for cluster_id, size, tokens in zip(
+        state["cluster_ids"], state["cluster_sizes"], state["cluster_tokens"]
+    ):
+        cluster = LogCluster([str(token) for token in tokens], int(cluster_id))
+        cluster.size = int(size)
+        drain.id_to_cluster[cluster.cluster_id] = cluster
+    drain.clusters_counter = int(state["clusters_counter"])
+    drain.root_node = _load_node(state["root"])
+    return template_miner
+
+
 # for gptscript workspace S/L, see https://github.com/gptscript-ai/py-gptscript/blob/main/gptscript/gptscript.py
-async def save_to_gptscript_workspace(filepath: str, content: str) -> None:
+async def save_to_gptscript_workspace(filepath: str, content: Union[str, bytes]) -> None:
     gptscript_client = gptscript.GPTScript()
     wksp_file_path = prepend_base_path('files', filepath)
-    await gptscript_client.write_file_in_workspace(wksp_file_path, content.encode('utf-8'))
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    await gptscript_client.write_file_in_workspace(wksp_file_path, content)
+
+
+# TODO: These should not be hardcoded. need to support snapshot for different input files
+SNAPSHOT_FILE = "last_template_snapshot.json.zst"
+# the raw log lines, newline-terminated, kept apart from the (small) JSON part
+SNAPSHOT_LINES_FILE = "last_template_snapshot_lines.txt.zst"
+# logs compress very well; level 3 is cheap next to the workspace/disk I/O it saves
+SNAPSHOT_ZSTD_LEVEL = 3
+
+
+def _encode_snapshot_lines(run_id: str, log_lines) -> bytes:
+    # the first line is the run id shared with the JSON part, see `_check_snapshot_run_id`
+    return "".join(itertools.chain([f"{run_id}\n"], (f"{line}\n" for line in log_lines))).encode("utf-8")
+
+
+def _check_snapshot_run_id(lines_run_id: str, run_id: str) -> None:
+    """The two snapshot files are written one after the other; make sure a lines file
+    left over from an earlier run is never paired with the current Drain state."""
+    if lines_run_id != run_id:
+        raise ValueError(
+            "The saved snapshot is incomplete (its files come from different runs). "
+            "Please analyze the log patterns again."
+        )
+
+
+def _iter_snapshot_lines(buffer, start=0):
+    """Lazily decode the lines of a decompressed snapshot lines file, from offset `start`."""
+    end = len(buffer)
+    while start < end:
+        newline = buffer.find(b"\n", start)
+        if newline == -1:
+            newline = end
+        yield buffer[start:newline].decode("utf-8")
+        start = newline + 1
+
+
+def _snapshot_lines(buffer, run_id: str):
+    """Check the run id heading a decompressed snapshot lines file and iterate the rest."""
+    header_end = buffer.find(b"\n")
+    if header_end == -1:
+        header_end = len(buffer)
+    _check_snapshot_run_id(buffer[:header_end].decode("utf-8"), run_id)
+    return _iter_snapshot_lines(buffer, header_end + 1)
+
+
+def _open_snapshot_lines_file(path, run_id: str):
+    """Check the run id heading a local snapshot lines file, then lazily read the rest of
+    it, decompressing as it goes."""
+    f = open(path, "rb")
+    try:
+        reader = io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(f), buffer_size=LOG_READ_BUFFER_SIZE
+        )
+        _check_snapshot_run_id(reader.readline().rstrip(b"\n").decode("utf-8"), run_id)
+    except BaseException:
+        f.close()
+        raise
+    return _iter_snapshot_lines_file(f, reader)
+
+
+def _iter_snapshot_lines_file(f, reader):
+    with f:
+        for line in reader:
+            yield line.rstrip(b"\n").decode("utf-8")
+
 
+async def save_snapshot(template_miner, log_lines, masked_line_clusters=None, cache_dir: str = "cache") -> Dict[str, Any]:
+    """Save the current state of clusters and processed logs
 
-async def save_snapshot(template_miner, log_lines, cache_dir: str = "cache") -> Dict[str, Any]:
-    """Save the current state of clusters and processed logs"""
+    The trained Drain state is saved too, so `extract` can restore the miner instead of
+    training it again, along with the masked line -> cluster id mapping when given.
+    The clusters and state are saved as JSON, the raw lines go to a separate text file,
+    both zstd-compressed. The clusters are stored as parallel `ids`, `sizes` and
+    `templates` arrays rather than one object per cluster.
+
+    The lines file is written first and both files carry the same run id, so that a
+    failed write can never leave the new state paired with an older lines file.
+    """
+    clusters = template_miner.drain.clusters
+    run_id = uuid.uuid4().hex
     snapshot = {
-        "clusters": [
-            {
-                "id": cluster.cluster_id,
-                "size": cluster.size,
-                "template": cluster.get_template(),
-            }
-            for cluster in template_miner.drain.clusters
-        ],
-        "log_lines": log_lines,
+        "run_id": run_id,
+        "ids": [cluster.cluster_id for cluster in clusters],
+        "sizes": [cluster.size for cluster in clusters],
+        "templates": [cluster.get_template() for cluster in clusters],
+        "drain_state": dump_template_miner_state(template_miner),
     }
-    
-    filepath = "last_template_snapshot.json" # TODO: This should not be hardcoded. need to support snapshot for different input files
+    if masked_line_clusters is not None:
+        snapshot["masked_line_clusters"] = masked_line_clusters
+
+    compressor = zstandard.ZstdCompressor(level=SNAPSHOT_ZSTD_LEVEL)
+    snapshot_content = compressor.compress(orjson.dumps(snapshot))
+    lines_content = compressor.compress(_encode_snapshot_lines(run_id, log_lines))
+    snapshot["log_lines"] = log_lines
 
     try:
-        await save_to_gptscript_workspace(filepath, json.dumps(snapshot))
-        print(f"Saved snapshot to workspace: {filepath}")
+        await save_to_gptscript_workspace(SNAPSHOT_LINES_FILE, lines_content)
+        await save_to_gptscript_workspace(SNAPSHOT_FILE, snapshot_content)
+        print(f"Saved snapshot to workspace: {SNAPSHOT_FILE}")
         return snapshot
     except Exception as e:
         # failed to save to workspace, try local file
-        print(f"Failed to save snapshot to workspace, saving to local file: {filepath}")
-        snapshot_path = os.path.join(cache_dir, filepath)
-        with open(snapshot_path, "w") as f:
-            json.dump(snapshot, f)
+        print(f"Failed to save snapshot to workspace, saving to local file: {SNAPSHOT_FILE}")
+        pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        with open(os.path.join(cache_dir, SNAPSHOT_LINES_FILE), "wb") as f:
+            f.write(lines_content)
+        with open(os.path.join(cache_dir, SNAPSHOT_FILE), "wb") as f:
+            f.write(snapshot_content)
 
         return snapshot
 
 
-async def load_from_gptscript_workspace(filepath: str) -> str:
+async def load_bytes_from_gptscript_workspace(filepath: str) -> bytes:
     gptscript_client = gptscript.GPTScript()
     wksp_file_path = prepend_base_path('files', filepath)
-    file_content = await gptscript_client.read_file_in_workspace(wksp_file_path)
+    return await gptscript_client.read_file_in_workspace(wksp_file_path)
+
+
+async def load_from_gptscript_workspace(filepath: str) -> str:
+    file_content = await load_bytes_from_gptscript_workspace(filepath)
     return file_content.decode('utf-8')
 
 
 async def load_snapshot(cache_dir: str = "cache") -> Dict[str, Any]:
-    """Load the last saved template snapshot""" 
-    filepath = "last_template_snapshot.json" # TODO: This should not be hardcoded. need to support snapshot for different input files
+    """Load the last saved template snapshot
+
+    `log_lines` is a lazy iterator over the saved lines.
+    Raises ValueError if the lines file does not belong to the same run.
+    """
     try: # try to load from workspace file
-        file_content = await load_from_gptscript_workspace(filepath)
-        return json.loads(file_content)
+        decompressor = zstandard.ZstdDecompressor()
+        snapshot = orjson.loads(
+            decompressor.decompress(await load_bytes_from_gptscript_workspace(SNAPSHOT_FILE))
+        )
+        lines_content = decompressor.decompress(
+            await load_bytes_from_gptscript_workspace(SNAPSHOT_LINES_FILE)
+        )
     except Exception as e:
         # failed to load from workspace, try local file
-        snapshot_path = os.path.join(cache_dir,filepath)
+        snapshot_path = os.path.join(cache_dir, SNAPSHOT_FILE)
         if not os.path.exists(snapshot_path):
             raise FileNotFoundError(
                 "No analysis snapshot found. Please analyze the log patterns first:\n"
                 f"python3 drain_parse.py --log_file_url '{os.getenv('LOG_FILE_URL')}' --action analyze"
             )
 
-        with open(snapshot_path, "r") as f:
-            return json.load(f)
+        with open(snapshot_path, "rb") as f:
+            snapshot = orjson.loads(zstandard.ZstdDecompressor().decompress(f.read()))
+        snapshot["log_lines"] = _open_snapshot_lines_file(
+            os.path.join(cache_dir, SNAPSHOT_LINES_FILE), snapshot["run_id"]
+        )
+        return snapshot
+
+    # checked outside the try above: a mismatch must not fall back to the local files
+    snapshot["log_lines"] = _snapshot_lines(lines_content, snapshot["run_id"])
+    return snapshot
 
 
 async def get_or_download_file(url: str, log_file: str = "", cache_dir: str = "cache") -> str:
@@ -319,8 +875,22 @@ async def get_or_download_file(url: str, log_file: str = "", cache_dir: str = "c
     # If file doesn't exist in cache, download it
     if not os.path.exists(cached_file_path):
         print(f"Downloading log file from {url}")
-        wget.download(url, cached_file_path)
-        print("\nDownload complete")
+        # stream into a temporary file so that a failed download never leaves a partial
+        # file behind to be mistaken for the cached copy
+        partial_file_path = f"{cached_file_path}.part"
+        try:
+            async with aiohttp.ClientSession(timeout=DOWNLOAD_TIMEOUT) as session:
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    async with aiofiles.open(partial_file_path, "wb") as f:
+                        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                            await f.write(chunk)
+        except BaseException:
+            if os.path.exists(partial_file_path):
+                os.remove(partial_file_path)
+            raise
+        os.replace(partial_file_path, cached_file_path)
+        print("Download complete")
     else:
         print(f"Using cached file: {cached_file_path}")
 
@@ -361,6 +931,8 @@ async def main():
         cached_log_file = await get_or_download_file(log_file_url, log_file)
         log_lines = get_log_lines(cached_log_file)
         if log_file:
+            # materialized once: the lines are reused for the workspace copy and the snapshot
+            log_lines = list(log_lines)
             try:
                 await save_to_gptscript_workspace(log_file, "\n".join(log_lines))
             except Exception as e:
@@ -368,48 +940,54 @@ async def main():
     elif not log_file:
         print("Error: Either LOG_FILE or LOG_FILE_URL must be provided")
         sys.exit(1)
-    else: # log_file is provided
-        try:
-            log_content = await load_from_gptscript_workspace(log_file)
-            log_lines = log_content.splitlines()
-        except Exception as e:
-            if not os.path.exists(log_file):
-                print("Error: Log file not found")
-                sys.exit(1)
-            else:
-                log_lines = get_log_lines(log_file)
+    else: # log_file is provided; only analyze reads it (extract works from the snapshot)
+        log_lines = None
+        if action == "analyze":
+            try:
+                log_content = await load_from_gptscript_workspace(log_file)
+                log_lines = [line.strip() for line in log_content.splitlines()]
+            except Exception as e:
+                if not os.path.exists(log_file):
+                    print("Error: Log file not found")
+                    sys.exit(1)
+                else:
+                    log_lines = get_log_lines(log_file)
 
 
     try:
         if action == "analyze":
-            clusters, template_miner, log_lines = get_log_templates(log_lines)
-            snapshot = await save_snapshot(template_miner, log_lines)
+            # only analyze reads the log lines (extract works from the snapshot); they are
+            # materialized here because the snapshot keeps them
+            log_lines = list(log_lines)
+            masked_line_counts = count_masked_lines(log_lines)
+            masked_line_clusters = {}
+            template_miner = train_template_miner(masked_line_counts, masked_line_clusters)
+            cached_masked_line_clusters = snapshot_masked_line_clusters(
+                masked_line_counts, masked_line_clusters
+            )
+            snapshot = await save_snapshot(
+                template_miner, log_lines, cached_masked_line_clusters
+            )
 
-            print(
-                json.dumps(
-                    {
-                        "message": "Analysis complete. You can now use 'extract' action with --cluster_id to get parameters.",
-                        "clusters": [
-                            {
-                                "id": c["id"],
-                                "size": c["size"],
-                                "template": c["template"],
-                            }
-                            for c in snapshot["clusters"]
-                        ],
-                    },
-                    indent=2,
-                )
+            print_json(
+                {
+                    "message": "Analysis complete. You can now use 'extract' action with --cluster_id to get parameters.",
+                    "clusters": [
+                        {"id": cid, "size": size, "template": template}
+                        for cid, size, template in zip(
+                            snapshot["ids"], snapshot["sizes"], snapshot["templates"]
+                        )
+                    ],
+                },
+                indent=True,
             )
 
         elif action == "extract":
             if not cluster_id:
-                print(
-                    json.dumps(
-                        {
-                            "error": "Cluster ID is required. Please run 'analyze' action first to see available cluster IDs"
-                        }
-                    )
+                print_json(
+                    {
+                        "error": "Cluster ID is required. Please run 'analyze' action first to see available cluster IDs"
+                    }
                 )
                 sys.exit(1)
 
@@ -417,62 +995,42 @@ async def main():
                 # Load the last snapshot instead of reprocessing
                 snapshot = await load_snapshot()
 
-                # Verify the cluster_id exists in the snapshot
-                cluster_exists = any(
-                    c["id"] == cluster_id for c in snapshot["clusters"]
-                )
-                if not cluster_exists:
-                    print(
-                        json.dumps(
-                            {
-                                "error": f"Cluster ID {cluster_id} not found in last template snapshot"
-                            }
-                        )
+                # Look up the cluster's template, which also verifies the cluster_id exists in the snapshot
+                templates_by_id = dict(zip(snapshot["ids"], snapshot["templates"]))
+                template = templates_by_id.get(cluster_id)
+                if template is None:
+                    print_json(
+                        {
+                            "error": f"Cluster ID {cluster_id} not found in last template snapshot"
+                        }
                     )
                     sys.exit(1)
 
-                # Reprocess only for parameter extraction using saved log lines
-                template_miner = parse_log_file(snapshot["log_lines"])
-                parameters = get_parameters_by_cluster(
-                    template_miner, snapshot["log_lines"]
+                # Restore the miner trained by `analyze` rather than training it again
+                template_miner = load_template_miner_state(snapshot["drain_state"])
+                masked_line_clusters = snapshot.get("masked_line_clusters", {})
+                parameters = get_parameters_for_cluster(
+                    template_miner, snapshot["log_lines"], cluster_id, masked_line_clusters
                 )
 
-                if cluster_id not in parameters:
-                    print(
-                        json.dumps(
-                            {
-                                "error": f"No parameters found for cluster ID {cluster_id}"
-                            }
-                        )
-                    )
-                else:
-                    print(
-                        json.dumps(
-                            {
-                                "cluster_id": cluster_id,
-                                "template": next(
-                                    c["template"]
-                                    for c in snapshot["clusters"]
-                                    if c["id"] == cluster_id
-                                ),
-                                "parameters": parameters[cluster_id],
-                            }
-                        )
-                    )
-
-            except FileNotFoundError:
-                print(
-                    json.dumps(
+                if not print_cluster_parameters(cluster_id, template, parameters):
+                    print_json(
                         {
-                            "error": "No analysis snapshot found. Please analyze the log patterns first:\n"
-                            f"python3 drain_parse.py --log_file_url '{log_file_url}' --action analyze"
+                            "error": f"No parameters found for cluster ID {cluster_id}"
                         }
                     )
+
+            except FileNotFoundError:
+                print_json(
+                    {
+                        "error": "No analysis snapshot found. Please analyze the log patterns first:\n"
+                        f"python3 drain_parse.py --log_file_url '{log_file_url}' --action analyze"
+                    }
                 )
                 sys.exit(1)
 
     except Exception as e:
-        print(json.dumps({"error": str(e)}))
+        print_json({"error": str(e)})
         sys.exit(1)
 
 
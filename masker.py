@@ -1,58 +1,116 @@
+import bisect
+import functools
 import logging
 import re
-from typing import List
+import sys
+from typing import List, Optional
 
 class MaskingInstruction:
     def __init__(self, regex_pattern: str, mask_with: str):
         self.regex_pattern = regex_pattern
         self.mask_with = mask_with
         self.regex = re.compile(regex_pattern)
-        self.mask_with_wrapped = "<" + mask_with + ">"
-    
-        
+        # interned: the same mask tokens are used as dict keys for every masked line
+        self.mask_with_wrapped = sys.intern("<" + mask_with + ">")
 
 
 class RegexMasker:
+    """Applies each masking instruction in turn, in list order: an earlier instruction
+    claims its text before any later one sees it.
+
+    The instructions are not fused into one alternation: at a given position an
+    alternation picks the first instruction that matches there, while applying them in
+    turn lets an earlier instruction claim a match that starts later in the line, so
+    fusing would change what gets masked.
+
+    Masking also stays on Python's `re` rather than RE2 or Hyperscan: the IP, DURATION
+    and NUM patterns rely on lookbehind and lookahead assertions, which neither supports.
+    """
+
     def __init__(
         self,
         masking_instructions: List[MaskingInstruction],
         masking_instructions_before_value_assign_token_split: List[MaskingInstruction],
+        prescreen_regex: Optional[str] = None,
     ):
         self.masking_instructions = masking_instructions
         self.masking_instructions_before_value_assign_token_split = (
             masking_instructions_before_value_assign_token_split
         )
         self.delimiters = r'([|:| \(|\)|\[|\]\'|\{|\}|"|,|=])'
+        self.delimiters_regex = re.compile(self.delimiters)
         self.remove_delimiters = r'([| \(|\)|\[|\]\'|\{|\}|"|,])'
         self.ansi_escape = re.compile(r"(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]")
+        self.value_assign_split = re.compile(r"([=|:])")
+        self.line_break_split = re.compile(r"[\n\r\t\r]")
+        # Optional cheap test for "could any masking instruction match this line?".
+        # Lines it does not match only go through token normalization.
+        self.prescreen = re.compile(prescreen_regex) if prescreen_regex else None
+
+    @staticmethod
+    def _apply(mi: MaskingInstruction, content: str, masked_parameters: dict) -> str:
+        matches = mi.regex.findall(content)
+        if not matches:
+            return content
+        token = mi.mask_with_wrapped
+        values = masked_parameters.get(token)
+        if values is None:
+            masked_parameters[token] = matches
+        else:
+            # an earlier instruction masked with the same token (the two IP patterns):
+            # slot each new value in among the earlier ones by where it sits in the line
+            masked_parameters[token] = RegexMasker._merge_by_offset(
+                token, content, values, mi.regex.finditer(content), matches
+            )
+        return mi.regex.sub(token, content)
+
+    @staticmethod
+    def _merge_by_offset(token: str, content: str, values: list, new_matches, new_values: list) -> list:
+        """Merge `new_values` into `values` (the values of the `token` placeholders already
+        in `content`, in line order) so that the result is in line order too."""
+        placeholder_offsets = []
+        at = content.find(token)
+        while at != -1:
+            placeholder_offsets.append(at)
+            at = content.find(token, at + len(token))
+
+        merged = []
+        taken = 0
+        for match, value in zip(new_matches, new_values):
+            preceding = bisect.bisect(placeholder_offsets, match.start())
+            merged.extend(values[taken:preceding])
+            merged.append(value)
+            taken = preceding
+        merged.extend(values[taken:])
+        return merged
 
     def mask(self, content: str):
+        """Return the masked line and a dict of mask token -> masked values, each list
+        in line order (values as `findall` returns them)."""
         # Track masked parameters
         masked_parameters = {}
 
         # Remove escape sequences
         content = self.ansi_escape.sub("", content)
 
+        apply_masks = self.prescreen is None or self.prescreen.search(content)
+
         # Apply pre-token-split masking
-        for mi in self.masking_instructions_before_value_assign_token_split:
-            matches = mi.regex.findall(content)
-            if len(matches) > 0:
-                masked_parameters[mi.mask_with_wrapped] = matches
-            content = mi.regex.sub(mi.mask_with_wrapped, content)
+        if apply_masks:
+            for mi in self.masking_instructions_before_value_assign_token_split:
+                content = self._apply(mi, content, masked_parameters)
 
         # Normalize tokens for consistent masking
-        content = " ".join(re.split(r"([=|:])", content))
-        content = " ".join(re.split(r"[\n\r\t\r]", content))
+        content = " ".join(self.value_assign_split.split(content))
+        content = " ".join(self.line_break_split.split(content))
 
         # Apply regular masking instructions
-        for mi in self.masking_instructions:
-            matches = mi.regex.findall(content)
-            if len(matches) > 0:
-                masked_parameters[mi.mask_with_wrapped] = matches
-            content = mi.regex.sub(mi.mask_with_wrapped, content)
+        if apply_masks:
+            for mi in self.masking_instructions:
+                content = self._apply(mi, content, masked_parameters)
 
         # Split on delimiters and remove unwanted tokens
-        split_content = re.split(self.delimiters, content)
+        split_content = self.delimiters_regex.split(content)
         content = " ".join(
             filter(lambda x: x not in self.remove_delimiters, split_content)
         )
@@ -97,6 +155,11 @@ masking_list = [
     {"regex_pattern": "\\[[\\s]*\\]", "mask_with": "EMPLIST"},
 ]
 
+# Every pattern in the two lists needs a digit, "/" (paths and "://" in URLs), "@" (emails),
+# "{" (EMPTY_SET) or "[" (EMPLIST) to match; a line with none of these is never masked.
+# Keep this in sync when adding a masking instruction.
+prescreen_regex = r"[\d/@{\[]"
+
 masking_list_before_value_assigning_token_split = [
     {
         "regex_pattern": "(http|ftp|https)://([\\w_-]+(?:(?:\\.*[\\w_-]+)+))([\\w.,@?^=%&:/~+#-]*[\\w@?^=%&/~+#-])?",
@@ -118,7 +181,7 @@ masking_list_before_value_assigning_token_split = [
 
 
 class LogMasker:
-    def __init__(self):
+    def __init__(self, cache_size: int = 4096):
         masking_instructions = []
         for mi in masking_list:
             instruction = MaskingInstruction(mi["regex_pattern"], mi["mask_with"])
@@ -132,7 +195,24 @@ class LogMasker:
         self.masker = RegexMasker(
             masking_instructions,
             masking_instructions_before_value_assigning_token_split,
+            prescreen_regex,
         )
+        # Raw log lines that repeat verbatim (no timestamp) skip the regexes. The cache is
+        # kept small: each process has its own, and timestamped lines never hit it. The
+        # returned parameters are shared: callers must not mutate them.
+        self.cache_size = cache_size
+        self._cached_mask = functools.lru_cache(maxsize=cache_size)(self.masker.mask)
+
+    def __getstate__(self):
+        # the cache wrapper cannot be pickled (e.g. to hand the masker to a worker
+        # process); it is rebuilt, empty, on the other side
+        state = self.__dict__.copy()
+        del state["_cached_mask"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cached_mask = functools.lru_cache(maxsize=self.cache_size)(self.masker.mask)
 
     def mask(self, content: str):
-        return self.masker.mask(content)
\ No newline at end of file
+        return self._cached_mask(content)
@@ -0,0 +1,70 @@
+import asyncio
+import os
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from drain_parse import get_or_download_file
+
+LOG_CONTENT = b"".join(b"connected to 10.0.0.%d port 8080\n" % i for i in range(200))
+
+
+async def truncated(request):
+    # announce more bytes than are sent, then drop the connection
+    response = web.StreamResponse(headers={"Content-Length": str(len(LOG_CONTENT) * 2)})
+    await response.prepare(request)
+    await response.write(LOG_CONTENT)
+    request.transport.close()
+    return response
+
+
+async def download(tmp_path, path, log_file=""):
+    """Serve LOG_CONTENT locally and download `path` from it into `tmp_path`."""
+    requests = []
+
+    async def log(request):
+        requests.append(request.path)
+        return web.Response(body=LOG_CONTENT)
+
+    app = web.Application()
+    app.router.add_get("/app.log", log)
+    app.router.add_get("/truncated.log", truncated)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        path = await get_or_download_file(
+            f"http://127.0.0.1:{port}{path}", log_file=log_file, cache_dir=str(tmp_path)
+        )
+        return path, requests
+    finally:
+        await runner.cleanup()
+
+
+def test_download_is_cached(tmp_path):
+    path, requests = asyncio.run(download(tmp_path, "/app.log"))
+
+    with open(path, "rb") as f:
+        assert f.read() == LOG_CONTENT
+    assert requests == ["/app.log"]
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+
+    # the port differs from one server to the next, so the cache is hit through log_file
+    assert asyncio.run(download(tmp_path, "/app.log", log_file=path)) == (path, [])
+
+
+@pytest.mark.parametrize(
+    "path, error",
+    [("/missing.log", aiohttp.ClientResponseError), ("/truncated.log", aiohttp.ClientPayloadError)],
+)
+def test_failed_download_leaves_no_cached_file(tmp_path, path, error):
+    log_file = str(tmp_path / "app.log")
+
+    with pytest.raises(error):
+        asyncio.run(download(tmp_path, path, log_file=log_file))
+
+    # neither the cached file nor the partial download is left behind
+    assert os.listdir(tmp_path) == []
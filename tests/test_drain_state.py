@@ -0,0 +1,71 @@
+import jsonpickle
+import orjson
+import pytest
+
+from drain_parse import (
+    dump_template_miner_state,
+    load_template_miner_state,
+    log_masker,
+    parse_log_file,
+)
+
+LOG_LINES = [
+    "connected to 10.0.0.1 port 8080",
+    "connected to 10.0.0.2 port 8081",
+    "request took 12.5ms",
+    "request took 3.5ms",
+    "all good here",
+]
+
+
+def test_restored_miner_matches_like_the_trained_one():
+    masked_line_clusters = {}
+    template_miner = parse_log_file(LOG_LINES, masked_line_clusters)
+
+    # through JSON, as in the snapshot
+    restored = load_template_miner_state(orjson.loads(orjson.dumps(dump_template_miner_state(template_miner))))
+
+    assert [(cluster.cluster_id, cluster.size, cluster.get_template()) for cluster in restored.drain.clusters] == [
+        (cluster.cluster_id, cluster.size, cluster.get_template()) for cluster in template_miner.drain.clusters
+    ]
+    assert restored.drain.clusters_counter == template_miner.drain.clusters_counter
+    for line in LOG_LINES:
+        masked_line, _ = log_masker.mask(line)
+        assert restored.match(masked_line).cluster_id == masked_line_clusters[masked_line]
+
+
+def test_drain_state_is_plain_data():
+    state = dump_template_miner_state(parse_log_file(LOG_LINES))
+
+    # no jsonpickle type tags anywhere in the saved state
+    assert b"py/" not in orjson.dumps(state)
+
+
+CALLS = []
+
+
+def record_call():
+    CALLS.append("called")
+
+
+class Payload:
+    def __reduce__(self):
+        return record_call, ()
+
+
+def test_crafted_drain_state_is_not_executed():
+    payload = orjson.loads(jsonpickle.encode(Payload(), keys=True))
+    state = {
+        "clusters_counter": payload,
+        "cluster_ids": [1],
+        "cluster_sizes": [payload],
+        "cluster_tokens": [payload],
+        "root": payload,
+    }
+
+    with pytest.raises((KeyError, TypeError, ValueError)):
+        load_template_miner_state(state)
+    assert CALLS == []
+    # the same payload does run when handed to jsonpickle, as drain3's load_state does
+    jsonpickle.decode(orjson.dumps(payload), keys=True)
+    assert CALLS == ["called"]
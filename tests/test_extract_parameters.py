@@ -0,0 +1,63 @@
+import copy
+
+from drain_parse import extract_parameters, log_masker
+
+
+def test_mask_tokens_take_their_values_in_order():
+    parameters = {"<IP>": [("", "10.0.0.2", ""), ("", "10.0.0.3", "")], "<NUM>": [("", "22", "")]}
+    original = copy.deepcopy(parameters)
+
+    assert extract_parameters("from <IP> to <IP> port <NUM>", "from <IP> to <IP> port <NUM>", parameters) == [
+        ("<IP>", ("", "10.0.0.2", "")),
+        ("<IP>", ("", "10.0.0.3", "")),
+        ("<NUM>", ("", "22", "")),
+    ]
+    # the masker's (memoized) result is left untouched
+    assert parameters == original
+
+
+def test_wildcard_joins_single_group_values():
+    parameters = {"<TOKENWITHDIGIT>": ["0x1f"]}
+
+    assert extract_parameters("pointer <*> freed", "pointer id<TOKENWITHDIGIT> freed", parameters) == [
+        ("<*>", "id0x1f")
+    ]
+
+
+def test_wildcard_with_multi_group_value_is_skipped():
+    # an IP's value holds its regex groups, not the matched text
+    parameters = {"<IP>": [("", "10.0.0.1", "")]}
+
+    assert extract_parameters("node <*> ready", "node ip-<IP> ready", parameters) == []
+
+
+def test_multi_group_value_in_a_mask_token_position():
+    parameters = {"<DURATION>": [("", "1.5 s", "s", "")]}
+
+    assert extract_parameters("took <DURATION>", "took <DURATION>", parameters) == [
+        ("<DURATION>", ("", "1.5 s", "s", ""))
+    ]
+
+
+def test_line_without_enough_values_is_dropped():
+    # more `<IP>` tokens than masked values, e.g. a literal `<IP>` in the raw line
+    parameters = {"<IP>": [("", "10.0.0.2", "")]}
+
+    assert extract_parameters("from <IP> to <IP>", "from <IP> to <IP>", parameters) == []
+    assert extract_parameters("from <IP> to <*>", "from <IP> to x<IP>", parameters) == []
+    assert extract_parameters("took <NUM>", "took <NUM>", parameters) == []
+
+
+def test_literal_template_and_length_mismatch():
+    assert extract_parameters("all good here", "all good here", {}) == []
+    assert extract_parameters("took <*>", "took a while", {}) == []
+
+
+def test_ip_values_follow_the_line_order_across_ip_patterns():
+    # the CIDR and the plain address are masked by two instructions sharing `<IP>`
+    masked_line, parameters = log_masker.mask("from 10.0.0.1 to 192.168.0.0/24 ok")
+
+    assert extract_parameters("from <IP> to <IP> ok", masked_line, parameters) == [
+        ("<IP>", ("", "10.0.0.1", "")),
+        ("<IP>", ("", "192.168.0.0/24", "")),
+    ]
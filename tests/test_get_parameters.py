@@ -0,0 +1,76 @@
+import logging
+
+import orjson
+
+from drain_parse import (
+    _parameters_for_lines,
+    get_parameters_by_cluster,
+    get_parameters_for_cluster,
+    log_masker,
+    parse_log_file,
+    print_cluster_parameters,
+)
+
+LOG_LINES = [
+    "connected to 10.0.0.1 port 8080",
+    "connected to 10.0.0.2 port 8081",
+    "request took 12.5ms",
+    "all good here",
+]
+
+
+class FailingMasker:
+    """Masks like the shared masker, but raises on one given line."""
+
+    def __init__(self, failing_line):
+        self.failing_line = failing_line
+
+    def mask(self, line):
+        if line == self.failing_line:
+            raise RuntimeError("cannot mask this line")
+        return log_masker.mask(line)
+
+
+def test_failing_line_is_dropped_from_its_batch(caplog):
+    template_miner = parse_log_file(LOG_LINES)
+    expected = _parameters_for_lines(template_miner, log_masker, {}, LOG_LINES)
+
+    with caplog.at_level(logging.WARNING):
+        results = _parameters_for_lines(
+            template_miner, FailingMasker(LOG_LINES[1]), {}, LOG_LINES
+        )
+
+    assert [entry["line"] for _, entry in expected] == LOG_LINES[:3]
+    assert results == [expected[0], expected[2]]
+    assert "cannot mask this line" in caplog.text
+
+
+def test_single_cluster_is_streamed_as_one_json_object(capsysbinary):
+    masked_line_clusters = {}
+    template_miner = parse_log_file(LOG_LINES, masked_line_clusters)
+    by_cluster = get_parameters_by_cluster(template_miner, LOG_LINES, dict(masked_line_clusters))
+    cluster_id = next(iter(by_cluster))
+    template = template_miner.drain.id_to_cluster[cluster_id].get_template()
+
+    entries = get_parameters_for_cluster(template_miner, LOG_LINES, cluster_id, masked_line_clusters)
+    assert print_cluster_parameters(cluster_id, template, entries)
+
+    assert orjson.loads(capsysbinary.readouterr().out) == {
+        "cluster_id": cluster_id,
+        "template": template,
+        "parameters": [
+            {
+                "line": entry["line"],
+                "parameters": [
+                    {"token": token, "value": list(value) if isinstance(value, tuple) else value}
+                    for token, value in entry["parameters"]
+                ],
+            }
+            for entry in by_cluster[cluster_id]
+        ],
+    }
+
+
+def test_nothing_is_written_without_entries(capsysbinary):
+    assert not print_cluster_parameters(1, "all good here", iter([]))
+    assert capsysbinary.readouterr().out == b""
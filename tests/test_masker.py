@@ -0,0 +1,99 @@
+import pytest
+
+from masker import (
+    LogMasker,
+    MaskingInstruction,
+    RegexMasker,
+    masking_list,
+    masking_list_before_value_assigning_token_split,
+)
+
+
+def plain_masker():
+    """The masker without the prescreen or the memoizing wrapper."""
+    return RegexMasker(
+        [MaskingInstruction(mi["regex_pattern"], mi["mask_with"]) for mi in masking_list],
+        [
+            MaskingInstruction(mi["regex_pattern"], mi["mask_with"])
+            for mi in masking_list_before_value_assigning_token_split
+        ],
+    )
+
+
+CASES = [
+    (
+        "connected to 10.0.0.1 port 8080",
+        "connected to <IP> port <NUM>",
+        {"<IP>": [("", "10.0.0.1", "")], "<NUM>": [("", "8080", "")]},
+    ),
+    # both IP instructions share a token: their values are kept, in line order
+    (
+        "route 192.168.1.0/24 via 10.0.0.1",
+        "route <IP> via <IP>",
+        {"<IP>": [("", "192.168.1.0/24", ""), ("", "10.0.0.1", "")]},
+    ),
+    (
+        "from 10.0.0.1 to 192.168.0.0/24 ok",
+        "from <IP> to <IP> ok",
+        {"<IP>": [("", "10.0.0.1", ""), ("", "192.168.0.0/24", "")]},
+    ),
+    (
+        "10.0.0.1 10.1.0.0/16 10.0.0.2 10.2.0.0/16 10.0.0.3",
+        "<IP> <IP> <IP> <IP> <IP>",
+        {
+            "<IP>": [
+                ("", "10.0.0.1", ""),
+                ("", "10.1.0.0/16", ""),
+                ("", "10.0.0.2", ""),
+                ("", "10.2.0.0/16", ""),
+                ("", "10.0.0.3", ""),
+            ]
+        },
+    ),
+    (
+        "10.0.0.2 10.0.0.3",
+        "<IP> <IP>",
+        {"<IP>": [("", "10.0.0.2", ""), ("", "10.0.0.3", "")]},
+    ),
+    ("ip-10.0.0.1 up", "ip-<IP> up", {"<IP>": [("", "10.0.0.1", "")]}),
+    ("request took 12.5ms", "request took <DURATION>", {"<DURATION>": [("", "12.5ms", "ms", "")]}),
+    (
+        "took 1.5 s and 2.25 ms",
+        "took <DURATION> and <DURATION>",
+        {"<DURATION>": [("", "1.5 s", "s", ""), ("", "2.25 ms", "ms", "")]},
+    ),
+    # hex values have no instruction of their own
+    (
+        "pointer 0x7ffdeadbeef freed",
+        "pointer <TOKENWITHDIGIT> freed",
+        {"<TOKENWITHDIGIT>": ["0x7ffdeadbeef"]},
+    ),
+    # `=` and `:` are split off before the regular instructions run
+    (
+        "retry=3 count:42",
+        "retry = <NUM> count : <NUM>",
+        {"<NUM>": [("", "3", ""), ("", "42", "")]},
+    ),
+    ("level=info msg=ready", "level = info msg = ready", {}),
+    # URLs are masked before the `=` / `:` split
+    (
+        "GET http://example.com/api?id=1 done",
+        "GET <URL> done",
+        {"<URL>": [("http", "example.com", "/api?id=1")]},
+    ),
+    ("all good here", "all good here", {}),
+]
+
+
+@pytest.mark.parametrize("line, masked_line, parameters", CASES)
+def test_mask(line, masked_line, parameters):
+    assert plain_masker().mask(line) == (masked_line, parameters)
+
+
+@pytest.mark.parametrize("line", [case[0] for case in CASES])
+def test_log_masker_matches_plain_masker(line):
+    # the prescreen and the memoized results must not change what gets masked
+    log_masker = LogMasker()
+    expected = plain_masker().mask(line)
+    assert log_masker.mask(line) == expected
+    assert log_masker.mask(line) == expected
@@ -0,0 +1,110 @@
+from collections import Counter
+
+import pytest
+
+import drain_parse
+from drain_parse import (
+    _count_masked_batch,
+    _count_masked_batch_in_worker,
+    _init_masking_worker,
+    _map_batches,
+    get_parameters_by_cluster,
+    log_masker,
+    parse_log_file,
+)
+from masker import MaskingInstruction, RegexMasker
+
+LOG_LINES = [
+    line
+    for i in range(6)
+    for line in (
+        f"connected to 10.0.0.{i} port 80{i}",
+        f"request took {i}.5ms",
+        f"user{i}@example.com logged in",
+        "all good here",
+    )
+]
+
+
+@pytest.fixture
+def small_batches(monkeypatch):
+    # several batches out of a handful of lines, so that the pool is used
+    monkeypatch.setattr(drain_parse, "PARALLEL_BATCH_SIZE", 5)
+
+
+def in_process_only(batch):
+    raise AssertionError("a multi-batch input must go to the worker pool")
+
+
+def test_batches_come_back_in_input_order(small_batches):
+    results = list(
+        _map_batches(
+            LOG_LINES,
+            in_process_only,
+            _count_masked_batch_in_worker,
+            processes=2,
+            initializer=_init_masking_worker,
+            initargs=(log_masker,),
+        )
+    )
+
+    assert results == [
+        _count_masked_batch(log_masker, LOG_LINES[start : start + 5])
+        for start in range(0, len(LOG_LINES), 5)
+    ]
+
+
+def test_single_batch_is_handled_in_process():
+    assert list(_map_batches(LOG_LINES, len, in_process_only, processes=2)) == [len(LOG_LINES)]
+
+
+def test_exactly_one_full_batch_is_handled_in_process(monkeypatch):
+    monkeypatch.setattr(drain_parse, "PARALLEL_BATCH_SIZE", len(LOG_LINES))
+
+    assert list(_map_batches(LOG_LINES, len, in_process_only, processes=2)) == [len(LOG_LINES)]
+    assert list(_map_batches([], len, in_process_only, processes=2)) == []
+
+
+def test_workers_extract_the_same_parameters(small_batches):
+    masked_line_clusters = {}
+    template_miner = parse_log_file(LOG_LINES, masked_line_clusters)
+
+    in_workers = get_parameters_by_cluster(
+        template_miner, LOG_LINES, dict(masked_line_clusters), processes=2
+    )
+    in_process = get_parameters_by_cluster(
+        template_miner, LOG_LINES, dict(masked_line_clusters), processes=1
+    )
+
+    assert in_workers == in_process
+    assert sum(len(entries) for entries in in_workers.values()) == 18
+
+
+def test_workers_count_the_same_masked_lines(small_batches):
+    assert drain_parse.count_masked_lines(LOG_LINES, processes=2) == Counter(
+        log_masker.mask(line)[0] for line in LOG_LINES
+    )
+
+
+def test_workers_use_the_given_masker(small_batches):
+    # masks every number, and nothing else
+    masker = RegexMasker([MaskingInstruction(r"\d+", "DIGITS")], [])
+    masked_line_clusters = {}
+    template_miner = parse_log_file(LOG_LINES, masked_line_clusters, masker=masker)
+
+    in_workers = get_parameters_by_cluster(
+        template_miner, LOG_LINES, dict(masked_line_clusters), processes=2, masker=masker
+    )
+    in_process = get_parameters_by_cluster(
+        template_miner, LOG_LINES, dict(masked_line_clusters), processes=1, masker=masker
+    )
+
+    assert in_workers == in_process
+    tokens = {
+        token
+        for entries in in_workers.values()
+        for entry in entries
+        for token, _ in entry["parameters"]
+    }
+    assert tokens <= {"<DIGITS>", "<*>"}
+    assert "<DIGITS>" in tokens
@@ -0,0 +1,172 @@
+import asyncio
+import os
+import shutil
+import sys
+
+import orjson
+import pytest
+import zstandard
+
+import drain_parse
+from drain_parse import (
+    SNAPSHOT_FILE,
+    SNAPSHOT_LINES_FILE,
+    dump_template_miner_state,
+    load_snapshot,
+    parse_log_file,
+    save_snapshot,
+    snapshot_masked_line_clusters,
+)
+
+LOG_LINES = [
+    "connected to 10.0.0.1 port 8080",
+    "connected to 10.0.0.2 port 8081",
+    "request took 12.5ms",
+    "request took 3.5ms",
+    "all good here",
+]
+
+
+@pytest.fixture
+def workspace(monkeypatch):
+    """Stand-in for the gptscript workspace; set `files` to None to make it unavailable."""
+
+    class Workspace:
+        files = {}
+
+    async def save(filepath, content):
+        if Workspace.files is None:
+            raise ConnectionError("no workspace")
+        Workspace.files[filepath] = content
+
+    async def load(filepath):
+        if Workspace.files is None:
+            raise ConnectionError("no workspace")
+        return Workspace.files[filepath]
+
+    monkeypatch.setattr(drain_parse, "save_to_gptscript_workspace", save)
+    monkeypatch.setattr(drain_parse, "load_bytes_from_gptscript_workspace", load)
+    return Workspace
+
+
+def analyze(cache_dir):
+    masked_line_clusters = {}
+    template_miner = parse_log_file(LOG_LINES, masked_line_clusters)
+    asyncio.run(save_snapshot(template_miner, LOG_LINES, masked_line_clusters, cache_dir=cache_dir))
+    return template_miner, masked_line_clusters
+
+
+def assert_round_trip(snapshot, template_miner, masked_line_clusters):
+    clusters = template_miner.drain.clusters
+    assert snapshot["ids"] == [cluster.cluster_id for cluster in clusters]
+    assert snapshot["sizes"] == [cluster.size for cluster in clusters]
+    assert snapshot["templates"] == [cluster.get_template() for cluster in clusters]
+    assert snapshot["masked_line_clusters"] == masked_line_clusters
+    assert list(snapshot["log_lines"]) == LOG_LINES
+
+    # restoring the miner from it is covered in test_drain_state.py
+    assert snapshot["drain_state"] == dump_template_miner_state(template_miner)
+
+
+@pytest.mark.parametrize("workspace_available", [True, False])
+def test_round_trip(workspace, tmp_path, workspace_available):
+    if not workspace_available:
+        workspace.files = None
+    template_miner, masked_line_clusters = analyze(str(tmp_path))
+
+    snapshot = asyncio.run(load_snapshot(cache_dir=str(tmp_path)))
+
+    assert_round_trip(snapshot, template_miner, masked_line_clusters)
+
+
+def test_lines_file_of_another_run_is_rejected(workspace, tmp_path):
+    workspace.files = None
+    analyze(str(tmp_path / "first"))
+    analyze(str(tmp_path / "second"))
+    shutil.copy(
+        os.path.join(tmp_path, "first", SNAPSHOT_LINES_FILE),
+        os.path.join(tmp_path, "second", SNAPSHOT_LINES_FILE),
+    )
+
+    with pytest.raises(ValueError, match="different runs"):
+        asyncio.run(load_snapshot(cache_dir=str(tmp_path / "second")))
+
+
+def test_workspace_mismatch_does_not_fall_back_to_local_files(workspace, tmp_path):
+    analyze(str(tmp_path))
+    first_lines = workspace.files[SNAPSHOT_LINES_FILE]
+    analyze(str(tmp_path))
+    workspace.files[SNAPSHOT_LINES_FILE] = first_lines
+
+    with pytest.raises(ValueError, match="different runs"):
+        asyncio.run(load_snapshot(cache_dir=str(tmp_path)))
+
+
+def test_interrupted_save_is_not_paired_with_the_old_state(workspace, tmp_path, monkeypatch):
+    analyze(str(tmp_path / "first"))
+    save = drain_parse.save_to_gptscript_workspace
+
+    async def save_lines_only(filepath, content):
+        if filepath == SNAPSHOT_FILE:
+            raise ConnectionError("workspace went away")
+        await save(filepath, content)
+
+    # the new lines file reaches the workspace, its JSON part does not
+    monkeypatch.setattr(drain_parse, "save_to_gptscript_workspace", save_lines_only)
+    analyze(str(tmp_path / "second"))
+
+    with pytest.raises(ValueError, match="different runs"):
+        asyncio.run(load_snapshot(cache_dir=str(tmp_path / "second")))
+
+
+@pytest.mark.parametrize("workspace_available", [True, False])
+@pytest.mark.parametrize("lines_content", [b"", b"connected to 10.0.0.1 port 8080\n"])
+def test_lines_file_without_the_run_id_is_rejected(workspace, tmp_path, workspace_available, lines_content):
+    # e.g. an empty file, or one holding only log lines
+    if not workspace_available:
+        workspace.files = None
+    analyze(str(tmp_path))
+    content = zstandard.ZstdCompressor().compress(lines_content)
+    if workspace_available:
+        workspace.files[SNAPSHOT_LINES_FILE] = content
+    else:
+        with open(os.path.join(tmp_path, SNAPSHOT_LINES_FILE), "wb") as f:
+            f.write(content)
+
+    with pytest.raises(ValueError, match="different runs"):
+        asyncio.run(load_snapshot(cache_dir=str(tmp_path)))
+
+
+def test_extract_does_not_read_the_log_file(workspace, tmp_path, monkeypatch, capsysbinary):
+    analyze(str(tmp_path))
+    capsysbinary.readouterr()
+    reads = []
+
+    async def load_log(filepath):
+        reads.append(filepath)
+        return "\n".join(LOG_LINES)
+
+    monkeypatch.setattr(drain_parse, "load_from_gptscript_workspace", load_log)
+    for name in ("LOG_FILE", "LOG_FILE_URL", "ACTION", "CLUSTER_ID"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(
+        sys, "argv", ["drain_parse.py", "--log_file", "app.log", "--action", "extract", "--cluster_id", "1"]
+    )
+
+    asyncio.run(drain_parse.main())
+
+    assert reads == []
+    assert orjson.loads(capsysbinary.readouterr().out)["cluster_id"] == 1
+
+
+def test_masked_line_cache_keeps_the_most_frequent_lines():
+    masked_line_counts = drain_parse.count_masked_lines(LOG_LINES + LOG_LINES[1:3] + LOG_LINES[2:3])
+    masked_line_clusters = {}
+    drain_parse.train_template_miner(masked_line_counts, masked_line_clusters)
+
+    cached = snapshot_masked_line_clusters(masked_line_counts, masked_line_clusters, size=2)
+
+    masked_lines = [drain_parse.log_masker.mask(line)[0] for line in LOG_LINES[1:3]]
+    assert cached == {masked_line: masked_line_clusters[masked_line] for masked_line in masked_lines}
+    assert snapshot_masked_line_clusters(masked_line_counts, masked_line_clusters) == masked_line_clusters
+